@@ -8,30 +8,67 @@
 4. 垃圾文件自动清理
 """
 
-from flask import Flask, request, render_template_string, send_file, redirect, url_for, jsonify
+from flask import Flask, request, send_file, redirect, url_for, jsonify
+from flask.json.provider import JSONProvider
+from werkzeug.exceptions import RequestEntityTooLarge
 import os
-import json
+import orjson
 from datetime import datetime, timedelta
 import uuid
+import hashlib
+import unicodedata
+import urllib.parse
 import gzip
+import zlib
 import shutil
 import threading  # 用于文件锁
 import time
+import contextlib
 import logging
 from logging.handlers import RotatingFileHandler
+try:
+    import fcntl  # 跨进程文件锁，Windows 上没有
+except ImportError:
+    fcntl = None
+
+class OrjsonProvider(JSONProvider):
+    """用 orjson 处理 jsonify / request.get_json，比标准库 json 快得多"""
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode('utf-8')
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
 # ==================== 配置常量 ====================
 # 使用绝对路径，解决部署环境下 CWD 不一致导致找不到文件夹的问题
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 UPLOAD_FOLDER = os.path.join(BASE_DIR, 'shared')
-MESSAGES_FILE = os.path.join(BASE_DIR, 'messages.json')
+MESSAGES_FILE = os.path.join(BASE_DIR, 'messages.jsonl')  # 每行一条留言，只追加
+MESSAGE_TOMBSTONES_FILE = os.path.join(BASE_DIR, 'messages.tombstones')  # 每行一个已删除的留言 ID
+LEGACY_MESSAGES_FILE = os.path.join(BASE_DIR, 'messages.json')  # 旧版整体 JSON 存储，启动时迁移
+MESSAGES_LOCK_FILE = os.path.join(BASE_DIR, 'messages.lock')  # 多进程部署时用 flock 互斥留言文件的写入
 TEMP_FOLDER = os.path.join(BASE_DIR, 'temp_uploads')
+GZIP_CACHE_FOLDER = os.path.join(BASE_DIR, 'gzip_cache')  # 文本文件的预压缩副本（不放在共享目录，避免出现在列表里）
 LOG_FILE = os.path.join(BASE_DIR, 'app.log')
 
 MAX_CONTENT_LENGTH = 500 * 1024 * 1024  # 500MB
 TEMP_FILE_CLEANUP_HOURS = 2  # 超过 2 小时的临时文件自动清理
+TEMP_CLEANUP_INTERVAL_SECONDS = 300  # 后台每 5 分钟检查一次临时文件
+# 反向代理直接发送文件，下载不再占用 Python 线程（默认关闭，直接运行时由 Flask 发送）
+# nginx：设置为内部 location 前缀，例如 '/protected'，并配置
+#   location /protected/ { internal; alias /path/to/shared/; sendfile on; tcp_nopush on; }
+X_ACCEL_REDIRECT_PREFIX = os.environ.get('X_ACCEL_REDIRECT_PREFIX', '').rstrip('/')
+# Apache（mod_xsendfile）：设置为 1，send_file 会改为返回 X-Sendfile 头
+USE_X_SENDFILE = os.environ.get('USE_X_SENDFILE') == '1'
+# 上传完成后为这些文本类型预先生成 gzip 副本，下载时直接发送，不用每次压缩
+GZIP_SIDECAR_EXTENSIONS = frozenset({'.txt', '.csv', '.json', '.html', '.js', '.css', '.xml', '.log'})
+CHUNK_SIZE = 512 * 1024  # 分片大小，必须与前端 CHUNK_SIZE 一致
+MAX_CHUNKS = -(-MAX_CONTENT_LENGTH // CHUNK_SIZE)  # 单个文件最多的分片数（向上取整）
+PARTIAL_FILENAME = 'upload.partial'  # 临时目录中正在写入的文件
 
 # ==================== 日志配置 ====================
 # 配置日志格式和处理器
@@ -63,29 +100,210 @@ logging.getLogger('werkzeug').setLevel(logging.ERROR)
 
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(TEMP_FOLDER, exist_ok=True)
-
-if not os.path.exists(MESSAGES_FILE):
-    with open(MESSAGES_FILE, 'w', encoding='utf-8') as f:
-        json.dump([], f)
+os.makedirs(GZIP_CACHE_FOLDER, exist_ok=True)
 
 app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH
 app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 0
+app.config['USE_X_SENDFILE'] = USE_X_SENDFILE
 
 # ==================== 文件锁机制 ====================
 # 解决问题 1：防止并发操作冲突
-file_locks = {}  # 格式: {文件路径: threading.Lock()}
-file_locks_lock = threading.Lock()  # 保护 file_locks 字典本身的锁
+# 固定数量的分段锁：按路径哈希取锁，不再为每个文件名新建锁，内存不会无限增长
+FILE_LOCK_STRIPES = 256  # 必须是 2 的幂
+file_lock_stripes = [threading.RLock() for _ in range(FILE_LOCK_STRIPES)]
 
 def get_file_lock(filepath):
     """
     获取文件锁（File Lock）
     作用：确保同一时间只有一个操作能访问同一个文件
     例如：正在上传 A.zip 时，不能同时删除 A.zip
+    同一路径永远拿到同一把锁；不同文件偶尔哈希到同一把锁只会多等一下，不影响正确性
+    使用 RLock，同一线程重复获取不会死锁
+    """
+    return file_lock_stripes[hash(os.path.normcase(filepath)) & (FILE_LOCK_STRIPES - 1)]
+
+
+# ==================== 留言存储 ====================
+# 追加写入的 JSONL：发留言只需一次 write，不再整体读出再重写
+# 删除留言只追加一条墓碑记录，读取时过滤，启动时压缩
+messages_lock = threading.Lock()  # 保护留言文件的追加和压缩（同一进程内）
+messages_cache = {'key': None, 'messages': []}  # 两个文件大小都没变时直接复用
+
+def read_jsonl(path, record_type):
+    """
+    读取 JSONL 文件，返回 (解析后的列表, 读取时的文件大小)
+    只解析到最后一个换行符，忽略其他线程正在追加的半行
+    无法解析或类型不是 record_type 的行（如崩溃时写了一半）直接跳过，不影响其他记录
+    """
+    try:
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            data = f.read(size)
+    except FileNotFoundError:
+        return [], 0
+    data = data[:data.rfind(b'\n') + 1]
+    
+    records = []
+    for line in data.splitlines():
+        if not line.strip():
+            continue
+        try:
+            record = orjson.loads(line)
+        except orjson.JSONDecodeError:
+            app.logger.warning(f"[留言] 跳过无法解析的记录: {os.path.basename(path)}")
+            continue
+        if isinstance(record, record_type):
+            records.append(record)
+    return records, size
+
+def live_messages(messages, deleted):
+    """过滤掉已删除和格式不对的留言（ID 必须是字符串）"""
+    return [msg for msg in messages if isinstance(msg.get('id'), str) and msg['id'] not in deleted]
+
+def message_sort_key(msg):
+    """按时间戳排序，时间戳缺失或格式不对时排在最后"""
+    timestamp = msg.get('timestamp', 0)
+    return timestamp if isinstance(timestamp, (int, float)) else 0
+
+def load_messages():
+    """读取全部留言（已过滤删除、按时间倒序），文件没有变化时使用缓存"""
+    try:
+        key = (os.path.getsize(MESSAGES_FILE), os.path.getsize(MESSAGE_TOMBSTONES_FILE))
+    except FileNotFoundError:
+        key = None
+    if key is not None and key == messages_cache['key']:
+        return messages_cache['messages']
+    
+    messages, messages_size = read_jsonl(MESSAGES_FILE, dict)
+    deleted, tombstones_size = read_jsonl(MESSAGE_TOMBSTONES_FILE, str)
+    messages = live_messages(messages, set(deleted))
+    messages.sort(key=message_sort_key, reverse=True)
+    
+    messages_cache.update(key=(messages_size, tombstones_size), messages=messages)
+    return messages
+
+@contextlib.contextmanager
+def messages_write_lock():
+    """
+    留言文件写锁：进程内用 threading.Lock，进程间用 flock
+    多 worker 部署时，一个进程压缩（替换文件）的同时另一个进程追加，留言会丢
+    """
+    with messages_lock:
+        if fcntl is None:
+            yield
+            return
+        with open(MESSAGES_LOCK_FILE, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)  # 关闭文件时自动释放
+            yield
+
+def append_jsonl(path, record):
+    """向 JSONL 文件追加一条记录"""
+    line = orjson.dumps(record) + b'\n'
+    with messages_write_lock():
+        with open(path, 'ab') as f:
+            f.write(line)
+
+def compact_messages():
+    """
+    启动时压缩留言文件：去掉已删除的留言，清空墓碑文件
+    如果只有旧版 messages.json，则迁移为 JSONL
+    """
+    with messages_write_lock():
+        if os.path.exists(MESSAGES_FILE):
+            messages, _ = read_jsonl(MESSAGES_FILE, dict)
+        elif os.path.exists(LEGACY_MESSAGES_FILE):
+            try:
+                with open(LEGACY_MESSAGES_FILE, 'rb') as f:
+                    messages = orjson.loads(f.read())
+            except orjson.JSONDecodeError as e:
+                app.logger.error(f"[留言] messages.json 无法解析，跳过迁移: {e}")
+                messages = []
+            if not isinstance(messages, list):
+                messages = []
+            messages = [msg for msg in messages if isinstance(msg, dict)]
+            app.logger.info(f"[留言] 从 messages.json 迁移 {len(messages)} 条留言")
+        else:
+            messages = []
+        
+        deleted, _ = read_jsonl(MESSAGE_TOMBSTONES_FILE, str)
+        
+        tmp_path = f"{MESSAGES_FILE}.{uuid.uuid4().hex}.tmp"  # 每次唯一，多个进程同时启动也不会互相覆盖
+        with open(tmp_path, 'wb') as f:
+            for msg in live_messages(messages, set(deleted)):
+                f.write(orjson.dumps(msg) + b'\n')
+        os.replace(tmp_path, MESSAGES_FILE)
+        open(MESSAGE_TOMBSTONES_FILE, 'w').close()
+
+
+# ==================== 文件列表缓存 ====================
+# 共享目录 mtime 不变，说明文件没有增删，直接复用上次的列表
+index_cache = {'mtime': -1, 'files': []}
+
+
+# ==================== 分片上传状态 ====================
+# 分片直接写入最终文件的对应偏移，不再单独保存、最后合并
+# 每收到一个分片，在 temp_dir/received/ 下建一个以序号命名的标记文件，
+# 全部到齐即完成，不依赖最后一片的到达顺序；记录在磁盘上，进程重启、多 worker 部署都不会丢
+# 内存中的位图只是本进程的缓存：本进程已看到全部分片时不必再扫描磁盘
+# 字典本身不加锁：get / setdefault / pop 在 CPython（GIL）下都是原子操作
+# 每个上传有自己的锁，只保护自己的位图，不同上传之间互不等待
+CHUNK_MARKERS_DIRNAME = 'received'  # 已收到分片的标记目录
+FINALIZE_CLAIM_FILENAME = 'finalizing'  # 抢到完成权的请求创建的文件
+partial_uploads = {}  # 格式: {uploadId: {'received': bytearray, 'remaining': 剩余分片数, 'lock': Lock}}
+
+def get_partial_upload(upload_id, total_chunks):
+    """
+    获取上传状态，不存在则创建
+    已存在时只是一次字典读取；并发创建时 setdefault 保证所有请求拿到同一个对象
+    （竞争失败的一方只是白白分配了一个状态）
+    """
+    state = partial_uploads.get(upload_id)
+    if state is None:
+        state = partial_uploads.setdefault(upload_id, {
+            'received': bytearray(total_chunks),
+            'remaining': total_chunks,
+            'lock': threading.Lock()
+        })
+    return state
+
+def mark_chunk_received(upload_id, temp_dir, chunk_index, total_chunks):
     """
-    with file_locks_lock:
-        if filepath not in file_locks:
-            file_locks[filepath] = threading.Lock()
-        return file_locks[filepath]
+    记录收到一个分片（分片内容写入后调用）
+    返回 True 表示分片已全部到齐，且由本请求负责完成上传（只会有一个请求拿到 True）
+    """
+    state = get_partial_upload(upload_id, total_chunks)
+    if len(state['received']) != total_chunks:
+        raise ValueError(f"分片总数不一致: {total_chunks}")
+    
+    markers_dir = os.path.join(temp_dir, CHUNK_MARKERS_DIRNAME)
+    os.makedirs(markers_dir, exist_ok=True)
+    open(os.path.join(markers_dir, str(chunk_index)), 'wb').close()
+    
+    with state['lock']:
+        if not state['received'][chunk_index]:
+            state['received'][chunk_index] = 1
+            state['remaining'] -= 1
+        complete = state['remaining'] == 0
+    
+    if not complete:
+        # 其他分片可能由别的进程、或重启前的进程收到，以磁盘上的标记为准
+        complete = len(os.listdir(markers_dir)) >= total_chunks
+    if not complete:
+        return False
+    
+    # 多个请求可能同时发现分片已到齐：O_EXCL 创建认领文件是原子的（跨进程也成立），只有一个请求能成功
+    try:
+        fd = os.open(os.path.join(temp_dir, FINALIZE_CLAIM_FILENAME), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    os.close(fd)
+    
+    partial_uploads.pop(upload_id, None)
+    return True
+
+def forget_partial_upload(upload_id):
+    """丢弃上传状态（取消上传、清理过期临时文件时调用）"""
+    partial_uploads.pop(upload_id, None)
 
 
 # ==================== 垃圾文件清理 ====================
@@ -112,16 +330,66 @@ def cleanup_temp_files():
             # 超过 2 小时，删除
             if age_hours > TEMP_FILE_CLEANUP_HOURS:
                 app.logger.info(f"[清理] 删除过期临时文件: {upload_id} (已存在 {age_hours:.1f} 小时)")
+                forget_partial_upload(upload_id)
                 remove_temp_dir(temp_dir, '清理')
     except Exception as e:
         app.logger.error(f"[清理] 清理临时文件时出错: {e}")
 
 
+cleanup_stop_event = threading.Event()  # 设置后后台清理线程立即退出
+
+def cleanup_worker():
+    """后台定时清理临时文件，不再由每次页面访问触发"""
+    while not cleanup_stop_event.wait(TEMP_CLEANUP_INTERVAL_SECONDS):
+        try:
+            cleanup_temp_files()
+        except Exception as e:
+            app.logger.error(f"[清理] 后台清理线程出错: {e}")
+
+
 # ==================== 启动时清理一次 ====================
 cleanup_temp_files()
+compact_messages()
+threading.Thread(target=cleanup_worker, daemon=True, name='temp-cleanup').start()
 
 
 # ==================== Gzip 压缩中间件 ====================
+GZIP_MIN_SIZE = 1400  # 小于一个 MTU 的响应压缩收益太小，直接跳过
+GZIP_LEVEL = 1  # 压缩级别 1：速度约为 6 的 3~4 倍，压缩率只差几个百分点
+
+# 本身已经压缩过的类型，再压缩只会白白浪费 CPU
+INCOMPRESSIBLE_MIMETYPES = frozenset({
+    'image/jpeg', 'image/png', 'image/webp', 'video/mp4',
+    'application/zip', 'application/gzip', 'application/x-7z-compressed',
+    'application/pdf',
+})
+
+def new_gzip_compressor():
+    """
+    创建 gzip 压缩流（wbits=31 表示带 gzip 头尾）
+    compressobj 不是线程安全的，flush 后也不能复用，所以每次响应都新建一个
+    """
+    return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+def gzip_stream(chunks, app_iter):
+    """
+    逐块压缩流式响应
+    每块写入后 Z_SYNC_FLUSH，立即把压缩结果交给客户端，
+    内存中只保留当前块，不会把整个响应缓冲下来
+    """
+    co = new_gzip_compressor()
+    try:
+        for chunk in chunks:
+            if not chunk:
+                continue
+            yield co.compress(chunk) + co.flush(zlib.Z_SYNC_FLUSH)
+        # 写入 gzip 尾部（CRC + 长度）
+        yield co.flush()
+    finally:
+        if hasattr(app_iter, 'close'):
+            app_iter.close()
+
+
 @app.after_request
 def compress_response(response):
     """Gzip 压缩响应，节省流量"""
@@ -132,434 +400,45 @@ def compress_response(response):
     if 'gzip' not in accept_encoding.lower():
         return response
     
-    if (response.direct_passthrough or 
-        len(response.get_data()) < 500 or
-        'Content-Encoding' in response.headers):
+    # send_file 的文件下载保持原样，保留 Content-Length（前端进度条）和 Range 支持
+    if response.direct_passthrough or 'Content-Encoding' in response.headers:
         return response
     
-    response.direct_passthrough = False
-    gzipped_data = gzip.compress(response.get_data(), compresslevel=6)
+    if response.mimetype in INCOMPRESSIBLE_MIMETYPES:
+        return response
     
-    response.set_data(gzipped_data)
-    response.headers['Content-Encoding'] = 'gzip'
-    response.headers['Content-Length'] = len(gzipped_data)
+    if response.is_streamed:
+        # 流式响应：替换为逐块压缩的生成器，改用 chunked 传输
+        response.response = gzip_stream(response.iter_encoded(), response.response)
+        response.headers.pop('Content-Length', None)
+    else:
+        # 普通响应：已经在内存中，直接一次性压缩
+        data = response.get_data()
+        if len(data) < GZIP_MIN_SIZE:
+            return response
+        co = new_gzip_compressor()
+        response.set_data(co.compress(data) + co.flush())
     
+    response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
     return response
 
 
-# ==================== HTML 模板 ====================
-HTML_TEMPLATE = '''
-<!DOCTYPE html>
-<html>
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>文件共享站</title>
-    <style>
-        *{margin:0;padding:0;box-sizing:border-box}
-        body{font-family:Arial,sans-serif;background:#f5f7fa;padding:10px}
-        .container{max-width:1200px;margin:0 auto}
-        .section{background:#fff;margin:15px 0;padding:20px;border-radius:8px;box-shadow:0 2px 8px rgba(0,0,0,.08)}
-        h1,h2{color:#2c3e50;margin-bottom:15px}
-        input,textarea,button{width:100%;padding:10px;margin:8px 0;border:2px solid #ddd;border-radius:6px;font-size:14px}
-        input[type="text"]{max-width:300px}
-        textarea{min-height:100px;resize:vertical;font-family:inherit}
-        button{background:#3498db;color:#fff;border:none;cursor:pointer;transition:.3s}
-        button:hover{background:#2980b9}
-        button:disabled{background:#95a5a6;cursor:not-allowed}
-        .delete-btn{background:#e74c3c;padding:6px 12px;font-size:12px;width:auto;display:inline-block}
-        .delete-btn:hover{background:#c0392b}
-        .download-btn{background:#27ae60;padding:6px 12px;font-size:12px;width:auto;display:inline-block;margin-right:5px}
-        
-        /* 上传任务列表 */
-        .upload-task{background:#f8f9fa;padding:15px;margin:10px 0;border-radius:6px;border-left:4px solid #3498db}
-        .upload-task.completed{border-left-color:#27ae60}
-        .upload-task.failed{border-left-color:#e74c3c}
-        .task-header{display:flex;justify-content:space-between;align-items:center;margin-bottom:10px}
-        .task-name{font-weight:bold;color:#2c3e50}
-        .task-status{font-size:12px;color:#7f8c8d}
-        
-        .progress-container{margin:10px 0}
-        .progress-bar{width:100%;height:24px;background:#ecf0f1;border-radius:12px;overflow:hidden;position:relative}
-        .progress-fill{height:100%;background:linear-gradient(90deg,#3498db,#2ecc71);transition:width .3s;border-radius:12px}
-        .progress-text{position:absolute;width:100%;text-align:center;line-height:24px;font-weight:bold;color:#2c3e50;z-index:1;font-size:12px}
-        .upload-info{font-size:12px;color:#7f8c8d;margin-top:5px}
-        
-        .file-item{display:flex;justify-content:space-between;align-items:center;padding:10px;margin:8px 0;background:#f8f9fa;border-radius:6px;border-left:4px solid #3498db}
-        .file-item a{text-decoration:none;color:#2c3e50;flex-grow:1}
-        .file-item a:hover{color:#3498db}
-        .message{background:#f8f9fa;padding:15px;margin:12px 0;border-radius:6px;border-left:4px solid #27ae60}
-        .message-header{display:flex;justify-content:space-between;margin-bottom:10px}
-        .message-author{font-weight:bold;color:#2c3e50}
-        .message-time{font-size:12px;color:#7f8c8d}
-        .message-content{white-space:pre-wrap;line-height:1.5;color:#34495e;word-wrap:break-word}
-        .empty-state{text-align:center;color:#7f8c8d;padding:30px}
-        
-        @media(max-width:768px){
-            .file-item{flex-direction:column;align-items:flex-start}
-            .delete-btn,.download-btn{margin-top:8px}
-        }
-    </style>
-</head>
-<body>
-    <div class="container">
-        <h1 style="text-align:center">📁 文件共享站（支持多文件并发上传）</h1>
-        
-        <!-- 文件上传区域 -->
-        <div class="section">
-            <h2>📤 上传文件</h2>
-            <input type="file" id="fileInput" multiple>
-            <button id="uploadBtn" onclick="addUploadTasks()">添加到上传队列</button>
-            <small style="color:#7f8c8d;display:block;margin-top:5px">
-                ✨ 支持多文件选择，支持并发上传，最大 500MB/文件
-            </small>
-            
-            <!-- 上传任务列表 -->
-            <div id="uploadTasks"></div>
-        </div>
-        
-        <!-- 文件列表 -->
-        <div class="section">
-            <h2>📋 共享文件 ({{ files|length }})</h2>
-            {% if files %}
-                {% for file in files %}
-                <div class="file-item">
-                    <a href="#" onclick="downloadFile('{{file.name}}');return false">
-                        📄 {{file.name}} <small>({{file.size}}, {{file.time}})</small>
-                    </a>
-                    <div>
-                        <button class="download-btn" onclick="downloadFile('{{file.name}}')">下载</button>
-                        <button class="delete-btn" onclick="deleteFile('{{file.name}}')">删除</button>
-                    </div>
-                </div>
-                {% endfor %}
-            {% else %}
-                <div class="empty-state">暂无文件</div>
-            {% endif %}
-        </div>
-        
-        <!-- 留言板 -->
-        <div class="section">
-            <h2>💬 留言板</h2>
-            <form method="post" action="/message">
-                <input type="text" name="name" placeholder="昵称" required maxlength="50">
-                <textarea name="message" placeholder="留言内容..." required maxlength="1000"></textarea>
-                <button type="submit">发送</button>
-            </form>
-        </div>
-        
-        <!-- 留言列表 -->
-        <div class="section">
-            <h2>📝 留言列表 ({{ messages|length }})</h2>
-            {% if messages %}
-                {% for msg in messages %}
-                <div class="message">
-                    <div class="message-header">
-                        <span class="message-author">{{msg.name}}</span>
-                        <div>
-                            <span class="message-time">{{msg.time}}</span>
-                            <button class="delete-btn" onclick="deleteMessage('{{msg.id}}')">删除</button>
-                        </div>
-                    </div>
-                    <div class="message-content">{{msg.content}}</div>
-                </div>
-                {% endfor %}
-            {% else %}
-                <div class="empty-state">暂无留言</div>
-            {% endif %}
-        </div>
-    </div>
-
-    <script>
-        // ==================== 配置 ====================
-        const CHUNK_SIZE = 512 * 1024;  // 512KB
-        const MAX_CONCURRENT_UPLOADS = 3;  // 最多同时上传 3 个文件
-        
-        // 上传任务队列
-        let uploadQueue = [];  // 等待上传的任务
-        let activeUploads = [];  // 正在上传的任务
-        
-        /**
-         * 添加上传任务到队列
-         * 解决问题 2：支持多文件同时上传
-         */
-        function addUploadTasks() {
-            const fileInput = document.getElementById('fileInput');
-            const files = fileInput.files;
-            
-            if (!files || files.length === 0) {
-                alert('请先选择文件！');
-                return;
-            }
-            
-            // 为每个文件创建上传任务
-            for (let i = 0; i < files.length; i++) {
-                const file = files[i];
-                const taskId = Date.now() + '-' + Math.random().toString(36).substr(2, 9);
-                
-                const task = {
-                    id: taskId,
-                    file: file,
-                    status: 'waiting',  // waiting | uploading | completed | failed | cancelled
-                    progress: 0,
-                    speed: 0,
-                    currentChunk: 0,
-                    totalChunks: Math.ceil(file.size / CHUNK_SIZE),
-                    cancelled: false
-                };
-                
-                uploadQueue.push(task);
-                renderTask(task);
-            }
-            
-            // 清空文件选择框
-            fileInput.value = '';
-            
-            // 开始处理队列
-            processQueue();
-        }
-        
-        /**
-         * 处理上传队列
-         * 解决问题 2：控制并发数，避免同时上传太多文件
-         */
-        function processQueue() {
-            // 检查是否有空闲槽位
-            while (activeUploads.length < MAX_CONCURRENT_UPLOADS && uploadQueue.length > 0) {
-                const task = uploadQueue.shift();
-                activeUploads.push(task);
-                uploadFile(task);
-            }
-        }
-        
-        /**
-         * 渲染上传任务 UI
-         */
-        function renderTask(task) {
-            const container = document.getElementById('uploadTasks');
-            
-            const taskDiv = document.createElement('div');
-            taskDiv.id = 'task-' + task.id;
-            taskDiv.className = 'upload-task';
-            taskDiv.innerHTML = `
-                <div class="task-header">
-                    <span class="task-name">📄 ${task.file.name}</span>
-                    <span class="task-status" id="status-${task.id}">等待上传...</span>
-                </div>
-                <div class="progress-container">
-                    <div class="progress-bar">
-                        <div class="progress-text" id="progress-text-${task.id}">0%</div>
-                        <div class="progress-fill" id="progress-fill-${task.id}" style="width:0%"></div>
-                    </div>
-                    <div class="upload-info" id="info-${task.id}">队列中...</div>
-                </div>
-                <button class="delete-btn" onclick="cancelUpload('${task.id}')" id="cancel-btn-${task.id}">取消</button>
-            `;
-            
-            container.appendChild(taskDiv);
-        }
-        
-        /**
-         * 上传文件（分片上传）
-         * 解决问题 3：每个文件独立的 uploadId，互不干扰
-         */
-        async function uploadFile(task) {
-            task.status = 'uploading';
-            updateTaskUI(task, '上传中...');
-            
-            try {
-                for (let i = 0; i < task.totalChunks; i++) {
-                    // 检查是否取消
-                    if (task.cancelled) {
-                        task.status = 'cancelled';
-                        updateTaskUI(task, '已取消');
-                        // 通知服务器清理临时文件
-                        await fetch('/cancel_upload', {
-                            method: 'POST',
-                            headers: {'Content-Type': 'application/json'},
-                            body: JSON.stringify({uploadId: task.id})
-                        });
-                        break;
-                    }
-                    
-                    const start = i * CHUNK_SIZE;
-                    const end = Math.min(start + CHUNK_SIZE, task.file.size);
-                    const chunk = task.file.slice(start, end);
-                    
-                    const formData = new FormData();
-                    formData.append('chunk', chunk);
-                    formData.append('chunkIndex', i);
-                    formData.append('totalChunks', task.totalChunks);
-                    formData.append('uploadId', task.id);  // 每个文件独立 ID
-                    formData.append('filename', task.file.name);
-                    
-                    const startTime = Date.now();
-                    await fetch('/upload_chunk', {method: 'POST', body: formData});
-                    const elapsed = (Date.now() - startTime) / 1000;
-                    
-                    task.currentChunk = i + 1;
-                    task.progress = ((i + 1) / task.totalChunks * 100).toFixed(1);
-                    task.speed = (chunk.size / elapsed / 1024).toFixed(1);
-                    
-                    updateTaskUI(task, `上传中 ${task.currentChunk}/${task.totalChunks} 片 | ${task.speed} KB/s`);
-                }
-                
-                if (!task.cancelled) {
-                    task.status = 'completed';
-                    updateTaskUI(task, '✅ 上传完成！');
-                    document.getElementById('task-' + task.id).className = 'upload-task completed';
-                    document.getElementById('cancel-btn-' + task.id).style.display = 'none';
-                    
-                    // 3 秒后刷新页面
-                    setTimeout(() => location.reload(), 3000);
-                }
-                
-            } catch (e) {
-                task.status = 'failed';
-                updateTaskUI(task, '❌ 上传失败: ' + e.message);
-                document.getElementById('task-' + task.id).className = 'upload-task failed';
-            } finally {
-                // 从活跃列表移除
-                activeUploads = activeUploads.filter(t => t.id !== task.id);
-                // 继续处理队列
-                processQueue();
-            }
-        }
-        
-        /**
-         * 更新任务 UI
-         */
-        function updateTaskUI(task, statusText) {
-            document.getElementById('status-' + task.id).textContent = statusText;
-            document.getElementById('progress-fill-' + task.id).style.width = task.progress + '%';
-            document.getElementById('progress-text-' + task.id).textContent = task.progress + '%';
-            document.getElementById('info-' + task.id).textContent = statusText;
-        }
-        
-        /**
-         * 取消上传
-         * 解决问题 4：标记取消，通知服务器清理
-         */
-        function cancelUpload(taskId) {
-            // 在队列中查找
-            let task = uploadQueue.find(t => t.id === taskId);
-            if (task) {
-                uploadQueue = uploadQueue.filter(t => t.id !== taskId);
-                document.getElementById('task-' + taskId).remove();
-                return;
-            }
-            
-            // 在活跃列表中查找
-            task = activeUploads.find(t => t.id === taskId);
-            if (task) {
-                task.cancelled = true;  // 标记取消，上传循环会检测
-            }
-        }
-        
-        /**
-         * 下载文件（带进度条）
-         */
-        async function downloadFile(filename) {
-            // 创建临时进度条（代码简化，你可以美化）
-            const taskId = 'download-' + Date.now();
-            const container = document.getElementById('uploadTasks');
-            
-            const taskDiv = document.createElement('div');
-            taskDiv.id = 'task-' + taskId;
-            taskDiv.className = 'upload-task';
-            taskDiv.innerHTML = `
-                <div class="task-header">
-                    <span class="task-name">📥 下载: ${filename}</span>
-                    <span class="task-status" id="status-${taskId}">下载中...</span>
-                </div>
-                <div class="progress-container">
-                    <div class="progress-bar">
-                        <div class="progress-text" id="progress-text-${taskId}">0%</div>
-                        <div class="progress-fill" id="progress-fill-${taskId}" style="width:0%"></div>
-                    </div>
-                    <div class="upload-info" id="info-${taskId}">正在下载...</div>
-                </div>
-            `;
-            container.appendChild(taskDiv);
-            
-            try {
-                const response = await fetch('/download/' + encodeURIComponent(filename));
-                const reader = response.body.getReader();
-                const contentLength = +response.headers.get('Content-Length');
-                
-                let receivedLength = 0;
-                let chunks = [];
-                
-                while (true) {
-                    const {done, value} = await reader.read();
-                    if (done) break;
-                    
-                    chunks.push(value);
-                    receivedLength += value.length;
-                    
-                    const progress = (receivedLength / contentLength * 100).toFixed(1);
-                    document.getElementById('progress-fill-' + taskId).style.width = progress + '%';
-                    document.getElementById('progress-text-' + taskId).textContent = progress + '%';
-                    document.getElementById('info-' + taskId).textContent = 
-                        `${(receivedLength/1024/1024).toFixed(2)} MB / ${(contentLength/1024/1024).toFixed(2)} MB`;
-                }
-                
-                const blob = new Blob(chunks);
-                const url = window.URL.createObjectURL(blob);
-                const a = document.createElement('a');
-                a.href = url;
-                a.download = filename;
-                a.click();
-                window.URL.revokeObjectURL(url);
-                
-                document.getElementById('status-' + taskId).textContent = '✅ 下载完成';
-                document.getElementById('task-' + taskId).className = 'upload-task completed';
-                
-                setTimeout(() => document.getElementById('task-' + taskId).remove(), 3000);
-                
-            } catch (e) {
-                alert('下载失败：' + e.message);
-                document.getElementById('task-' + taskId).remove();
-            }
-        }
-        
-        /**
-         * 删除文件
-         */
-        function deleteFile(filename) {
-            if (confirm('确定删除 "' + filename + '" ?')) {
-                fetch('/delete_file', {
-                    method: 'POST',
-                    headers: {'Content-Type': 'application/json'},
-                    body: JSON.stringify({filename: filename})
-                }).then(r => r.ok ? location.reload() : alert('删除失败'));
-            }
-        }
-        
-        /**
-         * 删除留言
-         */
-        function deleteMessage(messageId) {
-            if (confirm('确定删除留言?')) {
-                fetch('/delete_message', {
-                    method: 'POST',
-                    headers: {'Content-Type': 'application/json'},
-                    body: JSON.stringify({message_id: messageId})
-                }).then(r => r.ok ? location.reload() : alert('删除失败'));
-            }
-        }
-        
-        // 页面加载时清理过期临时文件
-        window.addEventListener('load', () => {
-            fetch('/cleanup_temp', {method: 'POST'});
-        });
-    </script>
-</body>
-</html>
-'''
+# ==================== 页面 ====================
+# 页面本身是静态的（文件和留言列表由前端请求 /api/listing 获取）
+# 启动时读取并以最高级别压缩一次，之后每次请求直接发送，不再渲染和压缩
+INDEX_HTML_FILE = os.path.join(BASE_DIR, 'static', 'index.html')
+INDEX_MAX_AGE = 300  # 浏览器缓存 5 分钟，过期后凭 ETag 验证
+
+with open(INDEX_HTML_FILE, 'rb') as f:
+    INDEX_HTML = f.read()
+INDEX_HTML_GZ = gzip.compress(INDEX_HTML, compresslevel=9)
+INDEX_ETAG = hashlib.md5(INDEX_HTML).hexdigest()
 
 
 # ==================== 工具函数 ====================
+FILENAME_SLASHES = str.maketrans({'/': None, '\\': None})
+
 def safe_filename(filename):
     """
     安全处理文件名，保留中文
@@ -567,23 +446,38 @@ def safe_filename(filename):
     """
     # 去除路径信息，只保留文件名
     filename = os.path.basename(filename)
-    # 替换掉可能导致路径穿越的字符
-    filename = filename.replace('..', '').replace('/', '').replace('\\', '')
+    # 去掉可能导致路径穿越的字符（斜杠用 translate 一次扫描去除）
+    filename = filename.translate(FILENAME_SLASHES).replace('..', '')
     if not filename:
         filename = 'unnamed_file'
     return filename
 
 def get_temp_dir_age_hours(temp_dir):
-    """计算临时目录自最后活动以来的小时数（含子文件 mtime）"""
-    latest = os.path.getmtime(temp_dir)
-    for root, _, files in os.walk(temp_dir):
-        for name in files:
-            file_path = os.path.join(root, name)
-            try:
-                latest = max(latest, os.path.getmtime(file_path))
-            except FileNotFoundError:
-                continue
-    return (time.time() - latest) / 3600
+    """
+    计算临时目录自最后活动以来的小时数（含子文件 mtime）
+    用 os.scandir 遍历，DirEntry.stat 复用目录读取的结果，每个文件只需一次系统调用
+    一旦发现未过期的文件就提前返回（此时返回值不超过清理阈值，目录肯定不会被删）
+    """
+    now = time.time()
+    latest = os.stat(temp_dir).st_mtime
+    stack = [temp_dir]
+    while stack:
+        if (now - latest) / 3600 <= TEMP_FILE_CLEANUP_HOURS:
+            break
+        try:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    try:
+                        st = entry.stat(follow_symlinks=False)
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                    except FileNotFoundError:
+                        continue
+                    if st.st_mtime > latest:
+                        latest = st.st_mtime
+        except FileNotFoundError:
+            continue
+    return (now - latest) / 3600
 
 def remove_temp_dir(temp_dir, context_tag):
     """统一删除临时目录，便于日志排查"""
@@ -597,45 +491,226 @@ def remove_temp_dir(temp_dir, context_tag):
         app.logger.error(f"[{context_tag}] 删除临时目录失败 {temp_dir}: {e}")
         return False
 
-def get_file_size(filepath):
-    """获取文件大小的友好显示"""
-    size = os.path.getsize(filepath)
-    for unit in ['B', 'KB', 'MB', 'GB']:
-        if size < 1024:
-            return f"{size:.1f}{unit}"
-        size /= 1024
-    return f"{size:.1f}TB"
+def write_chunk_at(path, src, offset, limit):
+    """
+    把分片内容写到 path 的指定偏移处（位置写入，与分片到达顺序无关）
+    每个请求单独打开文件，多个分片可以同时写入同一个文件
+    最多写入 limit 字节：chunked 编码的请求没有 Content-Length，
+    只能在读取时限制，否则会覆盖后面分片的区间
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | getattr(os, 'O_BINARY', 0), 0o644)
+    try:
+        remaining = limit
+        while remaining:
+            data = src.read(min(1 << 20, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            view = memoryview(data)
+            while view:
+                if hasattr(os, 'pwrite'):
+                    written = os.pwrite(fd, view, offset)
+                else:
+                    # Windows 没有 pwrite；文件描述符是本请求独占的，lseek + write 同样安全
+                    os.lseek(fd, offset, os.SEEK_SET)
+                    written = os.write(fd, view)
+                view = view[written:]
+                offset += written
+        
+        if not remaining and src.read(1):
+            raise RequestEntityTooLarge(f"分片过大: 超过 {limit} 字节")
+    finally:
+        os.close(fd)
+
+def sync_and_drop_cache(path):
+    """
+    把文件内容刷到磁盘，并提示内核丢弃它的页缓存
+    刚上传的大文件很少马上被再次读取，留在缓存里只会挤掉其他常用数据
+    （DONTNEED 只会丢弃干净页，所以要先 fsync）
+    """
+    fd = os.open(path, os.O_WRONLY | getattr(os, 'O_BINARY', 0))
+    try:
+        os.fsync(fd)
+        if hasattr(os, 'posix_fadvise'):  # Windows / macOS 没有
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+def format_file_size(size):
+    """文件大小的友好显示（整数比较选单位，只在最后格式化时做一次除法）"""
+    if size < 1 << 10:
+        return f"{size}B"
+    if size < 1 << 20:
+        return f"{size / (1 << 10):.1f}KB"
+    if size < 1 << 30:
+        return f"{size / (1 << 20):.1f}MB"
+    if size < 1 << 40:
+        return f"{size / (1 << 30):.1f}GB"
+    return f"{size / (1 << 40):.1f}TB"
+
+def list_shared_files():
+    """
+    列出共享目录中的文件（按创建时间倒序）
+    结果按目录 mtime 缓存：目录内容没变时直接复用，不再逐个 stat
+    """
+    folder_mtime = os.stat(UPLOAD_FOLDER).st_mtime_ns
+    if folder_mtime == index_cache['mtime']:
+        return index_cache['files']
+    
+    entries = []
+    with os.scandir(UPLOAD_FOLDER) as it:
+        for entry in it:
+            try:
+                if not entry.is_file():
+                    continue
+                st = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_ctime, {
+                'name': entry.name,
+                'size': format_file_size(st.st_size),
+                'time': datetime.fromtimestamp(st.st_ctime).strftime('%m-%d %H:%M')
+            }))
+    
+    entries.sort(key=lambda x: x[0], reverse=True)
+    files = [file for _, file in entries]
+    index_cache.update(mtime=folder_mtime, files=files)
+    return files
+
+def x_accel_response(filename):
+    """构造交给 nginx 发送文件的空响应（X-Accel-Redirect）"""
+    response = app.response_class(mimetype='application/octet-stream')
+    response.headers['X-Accel-Redirect'] = f"{X_ACCEL_REDIRECT_PREFIX}/{urllib.parse.quote(filename)}"
+    # 中文文件名按 RFC 5987 编码，与 send_file 的处理方式一致
+    try:
+        filename.encode('ascii')
+    except UnicodeEncodeError:
+        response.headers.set(
+            'Content-Disposition', 'attachment',
+            filename=unicodedata.normalize('NFKD', filename).encode('ascii', 'ignore').decode('ascii'),
+            **{'filename*': f"UTF-8''{urllib.parse.quote(filename)}"}
+        )
+    else:
+        response.headers.set('Content-Disposition', 'attachment', filename=filename)
+    return response
+
+def listing_etag():
+    """
+    根据共享目录和留言文件的修改时间/大小生成 ETag
+    文件增删会改变目录 mtime，发/删留言会改变留言文件大小
+    （弱 ETag：响应可能被 gzip 压缩，内容相同但字节不同）
+    """
+    parts = [os.stat(UPLOAD_FOLDER).st_mtime_ns]
+    for path in (MESSAGES_FILE, MESSAGE_TOMBSTONES_FILE):
+        try:
+            st = os.stat(path)
+            parts += [st.st_mtime_ns, st.st_size]
+        except FileNotFoundError:
+            parts += [0, 0]
+    return '-'.join(f'{part:x}' for part in parts)
+
+def gzip_sidecar_path(filepath, st):
+    """
+    共享文件对应的预压缩副本路径：gzip_cache/<文件名>/<大小>-<mtime_ns>.gz
+    副本名绑定原文件的大小和修改时间，原文件一变（重新上传同名文件）旧副本就不会再被命中
+    """
+    return os.path.join(GZIP_CACHE_FOLDER, os.path.basename(filepath), f"{st.st_size:x}-{st.st_mtime_ns:x}.gz")
+
+def remove_gzip_sidecars(filename):
+    """删除某个共享文件的全部预压缩副本（调用方需持有该文件的锁）"""
+    shutil.rmtree(os.path.join(GZIP_CACHE_FOLDER, filename), ignore_errors=True)
+
+def build_gzip_sidecar(filepath):
+    """
+    生成预压缩副本（在后台线程中运行，压缩只在上传时做一次）
+    先写临时文件再改名，下载时不会读到写了一半的副本
+    压缩期间原文件被删除或替换时，丢弃生成的副本
+    """
+    tmp_path = None
+    try:
+        with open(filepath, 'rb') as src:
+            # 用打开的文件本身的 stat，保证副本名和压缩的内容对应同一个文件
+            st = os.fstat(src.fileno())
+            sidecar_path = gzip_sidecar_path(filepath, st)
+            os.makedirs(os.path.dirname(sidecar_path), exist_ok=True)
+            tmp_path = sidecar_path + '.tmp'
+            with gzip.open(tmp_path, 'wb', compresslevel=9) as dst:
+                shutil.copyfileobj(src, dst, length=1 << 20)
+        os.replace(tmp_path, sidecar_path)
+        tmp_path = None
+        
+        try:
+            current = os.stat(filepath)
+            unchanged = (current.st_size, current.st_mtime_ns) == (st.st_size, st.st_mtime_ns)
+        except FileNotFoundError:
+            unchanged = False
+        if not unchanged:
+            os.remove(sidecar_path)
+    except Exception as e:
+        app.logger.error(f"[预压缩] 生成失败 {filepath}: {e}")
+    finally:
+        if tmp_path:
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+
+def fresh_gzip_sidecar(filepath):
+    """返回与原文件当前内容对应的预压缩副本路径；没有时返回 None"""
+    try:
+        sidecar_path = gzip_sidecar_path(filepath, os.stat(filepath))
+    except FileNotFoundError:
+        return None
+    return sidecar_path if os.path.exists(sidecar_path) else None
+
+def touch_upload_folder():
+    """上传/删除后刷新共享目录 mtime，确保文件列表缓存失效"""
+    os.utime(UPLOAD_FOLDER, None)
 
 
 # ==================== 路由 ====================
 
 @app.route('/')
 def index():
-    """主页"""
-    files = []
-    if os.path.exists(UPLOAD_FOLDER):
-        for filename in os.listdir(UPLOAD_FOLDER):
-            filepath = os.path.join(UPLOAD_FOLDER, filename)
-            if os.path.isfile(filepath):
-                files.append({
-                    'name': filename,
-                    'size': get_file_size(filepath),
-                    'time': datetime.fromtimestamp(os.path.getctime(filepath)).strftime('%m-%d %H:%M')
-                })
+    """主页（预压缩的静态页面，支持 ETag 304）"""
+    if 'gzip' in request.headers.get('Accept-Encoding', '').lower():
+        response = app.response_class(INDEX_HTML_GZ, mimetype='text/html')
+        response.headers['Content-Encoding'] = 'gzip'
+        response.set_etag(INDEX_ETAG + '-gzip')
+    else:
+        response = app.response_class(INDEX_HTML, mimetype='text/html')
+        response.set_etag(INDEX_ETAG)
     
-    files.sort(key=lambda x: os.path.getctime(os.path.join(UPLOAD_FOLDER, x['name'])), reverse=True)
+    response.vary.add('Accept-Encoding')
+    response.cache_control.max_age = INDEX_MAX_AGE
+    return response.make_conditional(request)
+
+
+@app.route('/api/listing')
+def api_listing():
+    """
+    文件列表和留言列表（主页加载后由前端获取）
+    内容没变时直接返回 304，不再读取列表和留言
+    """
+    etag = listing_etag()
+    if request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+        response.set_etag(etag, weak=True)
+        return response
     
-    messages = []
-    if os.path.exists(MESSAGES_FILE):
-        try:
-            with open(MESSAGES_FILE, 'r', encoding='utf-8') as f:
-                messages = json.load(f)
-        except:
-            messages = []
+    files = list_shared_files()
     
-    messages.sort(key=lambda x: x.get('timestamp', 0), reverse=True)
+    try:
+        messages = load_messages()
+    except Exception as e:
+        app.logger.error(f"[留言] 读取留言失败: {e}")
+        messages = []
     
-    return render_template_string(HTML_TEMPLATE, files=files, messages=messages)
+    response = jsonify({'files': files, 'messages': messages})
+    # no-cache：浏览器每次都要验证，但内容没变时只需一个 304
+    response.set_etag(etag, weak=True)
+    response.cache_control.no_cache = True
+    return response
 
 
 @app.route('/upload_chunk', methods=['POST'])
@@ -645,14 +720,14 @@ def upload_chunk():
     解决问题 1 & 2 & 3：
     - 使用文件锁防止并发冲突
     - 每个文件用独立 uploadId
-    - 支持断点续传
+    - 分片按偏移直接写入，顺序无关，可并行上传
     """
     try:
-        chunk = request.files['chunk']
-        chunk_index = int(request.form['chunkIndex'])
-        total_chunks = int(request.form['totalChunks'])
-        upload_id = request.form['uploadId']  # 每个文件独立的 ID
-        raw_filename = request.form['filename']
+        # 分片内容是原始请求体，元数据放在查询参数里（不走 multipart 解析）
+        chunk_index = int(request.args['chunkIndex'])
+        total_chunks = int(request.args['totalChunks'])
+        upload_id = request.args['uploadId']  # 每个文件独立的 ID
+        raw_filename = request.args['filename']
         filename = safe_filename(raw_filename)
         raw_ext = os.path.splitext(raw_filename)[1]
         sanitized_ext = os.path.splitext(filename)[1]
@@ -662,17 +737,27 @@ def upload_chunk():
         elif filename != raw_filename:
             app.logger.info(f"[上传] 文件名规范化: {raw_filename} -> {filename}")
         
+        # 分片数由客户端提供，必须限制上限，否则一个请求就能分配巨大的位图、写出巨大的稀疏文件
+        if not 0 < total_chunks <= MAX_CHUNKS or not 0 <= chunk_index < total_chunks:
+            app.logger.warning(f"[上传] 分片参数非法: {chunk_index}/{total_chunks}, ID: {upload_id}")
+            return jsonify({'success': False, 'error': '分片参数非法'}), 400
+        if (request.content_length or 0) > CHUNK_SIZE:
+            app.logger.warning(f"[上传] 分片过大: {request.content_length}, ID: {upload_id}")
+            return jsonify({'success': False, 'error': '分片过大'}), 413
+        
         # 创建临时目录
         temp_dir = os.path.join(TEMP_FOLDER, upload_id)
         os.makedirs(temp_dir, exist_ok=True)
         
-        # 保存分片（不需要锁，因为每个 uploadId 独立）
-        chunk_path = os.path.join(temp_dir, f'chunk_{chunk_index}')
-        chunk.save(chunk_path)
+        # 请求体直接写入文件（不需要锁，每个分片写不同的区间）
+        partial_path = os.path.join(temp_dir, PARTIAL_FILENAME)
+        write_chunk_at(partial_path, request.stream, chunk_index * CHUNK_SIZE, CHUNK_SIZE)
         
-        # 如果是最后一片，合并文件
-        if chunk_index == total_chunks - 1:
+        # 所有分片到齐，移动到共享目录
+        complete = False
+        if mark_chunk_received(upload_id, temp_dir, chunk_index, total_chunks):
             final_path = os.path.join(UPLOAD_FOLDER, filename)
+            sync_and_drop_cache(partial_path)
             
             # 🔒 获取文件锁（防止正在删除该文件）
             lock = get_file_lock(final_path)
@@ -684,20 +769,26 @@ def upload_chunk():
                     filename = f"{name}_{timestamp}{ext}"
                     final_path = os.path.join(UPLOAD_FOLDER, filename)
                 
-                # 合并文件
-                with open(final_path, 'wb') as final_file:
-                    for i in range(total_chunks):
-                        chunk_file_path = os.path.join(temp_dir, f'chunk_{i}')
-                        if not os.path.exists(chunk_file_path):
-                            raise Exception(f"分片 {i} 丢失！")
-                        with open(chunk_file_path, 'rb') as chunk_file:
-                            final_file.write(chunk_file.read())
+                # 清掉同名旧文件可能遗留的预压缩副本
+                remove_gzip_sidecars(filename)
+                os.replace(partial_path, final_path)
+                touch_upload_folder()
                 
                 # 删除临时文件夹
-                remove_temp_dir(temp_dir, '上传合并')
+                remove_temp_dir(temp_dir, '上传完成')
                 app.logger.info(f"[上传完成] 文件: {filename}, ID: {upload_id}")
+            complete = True
+            
+            if os.path.splitext(filename)[1].lower() in GZIP_SIDECAR_EXTENSIONS:
+                threading.Thread(target=build_gzip_sidecar, args=(final_path,), daemon=True).start()
         
-        return jsonify({'success': True})
+        # complete 只在真正完成文件的那个请求中为 True，前端据此确认上传成功
+        return jsonify({'success': True, 'complete': complete})
+    
+    except RequestEntityTooLarge as e:
+        # chunked 编码的请求体没有 Content-Length，只能在写入时发现超限
+        app.logger.warning(f"[上传] {e.description}, ID: {upload_id}")
+        return jsonify({'success': False, 'error': '分片过大'}), 413
     
     except Exception as e:
         app.logger.error(f"[上传失败] ID: {upload_id}, 错误: {e}")
@@ -715,6 +806,7 @@ def cancel_upload():
         upload_id = data.get('uploadId')
         
         if upload_id:
+            forget_partial_upload(upload_id)
             temp_dir = os.path.join(TEMP_FOLDER, upload_id)
             if os.path.exists(temp_dir):
                 remove_temp_dir(temp_dir, '取消')
@@ -726,46 +818,65 @@ def cancel_upload():
         return jsonify({'success': False, 'error': str(e)}), 500
 
 
-@app.route('/cleanup_temp', methods=['POST'])
-def cleanup_temp():
-    """
-    手动清理临时文件的路由
-    前端页面加载时会调用
-    """
-    cleanup_temp_files()
-    return jsonify({'success': True})
-
-
 @app.route('/download/<path:filename>')
 def download(filename):
     """
-    文件下载路由（加锁版本）
-    解决问题 1：下载时防止文件被删除
+    文件下载路由
+    不加文件锁：send_file 只是打开文件交给 WSGI 服务器，真正的读取发生在路由返回之后，
+    加锁也保护不到；而文件一旦打开，之后被删除（POSIX unlink）也不影响读取
+    支持 Range 断点续传和 If-None-Match / If-Modified-Since 304
+    客户端支持 gzip 且有预压缩副本时，直接发送副本（Content-Encoding: gzip）
+    配置了 X_ACCEL_REDIRECT_PREFIX 时交给 nginx 发送文件
     """
     # 确保文件名被正确解码（处理中文和特殊字符）
-    import urllib.parse
     filename = urllib.parse.unquote(filename)
     filename = os.path.basename(filename)
     filepath = os.path.join(UPLOAD_FOLDER, filename)
     
-    # 🔒 获取文件锁
-    lock = get_file_lock(filepath)
-    with lock:
-        if not os.path.exists(filepath):
-            return jsonify({'error': '文件不存在'}), 404
+    if not os.path.exists(filepath):
+        return jsonify({'error': '文件不存在'}), 404
+    
+    if X_ACCEL_REDIRECT_PREFIX:
+        return x_accel_response(filename)
+    
+    try:
+        sidecar_path = None
+        if 'gzip' in request.headers.get('Accept-Encoding', '').lower():
+            sidecar_path = fresh_gzip_sidecar(filepath)
+        
+        if sidecar_path:
+            original_size = os.path.getsize(filepath)
+            response = send_file(
+                sidecar_path,
+                as_attachment=True,
+                download_name=filename,
+                conditional=True,
+                etag=True
+            )
+            response.headers['Content-Encoding'] = 'gzip'
+            # Content-Length 是压缩后的大小，前端进度条需要原始大小
+            response.headers['X-Uncompressed-Length'] = original_size
+            response.vary.add('Accept-Encoding')
+            return response
         
         return send_file(
             filepath,
             as_attachment=True,
-            download_name=filename
+            download_name=filename,
+            conditional=True,
+            etag=True
         )
+    except FileNotFoundError:
+        # 检查之后、打开之前文件被删除
+        return jsonify({'error': '文件不存在'}), 404
 
 
 @app.route('/delete_file', methods=['POST'])
 def delete_file():
     """
     删除文件路由（加锁版本）
-    解决问题 1：删除时防止文件正在上传/下载
+    解决问题 1：删除时防止文件正在上传
+    正在进行的下载不受影响：已打开的文件在 POSIX 上被删除后仍可继续读取
     """
     try:
         data = request.get_json()
@@ -780,6 +891,8 @@ def delete_file():
             with lock:
                 if os.path.exists(filepath):
                     os.remove(filepath)
+                    touch_upload_folder()
+                    remove_gzip_sidecars(filename)
                     app.logger.info(f"[删除文件] {filename}")
                     return jsonify({'success': True})
         
@@ -806,18 +919,7 @@ def add_message():
         'timestamp': datetime.now().timestamp()
     }
     
-    messages = []
-    if os.path.exists(MESSAGES_FILE):
-        try:
-            with open(MESSAGES_FILE, 'r', encoding='utf-8') as f:
-                messages = json.load(f)
-        except:
-            messages = []
-    
-    messages.append(new_message)
-    
-    with open(MESSAGES_FILE, 'w', encoding='utf-8') as f:
-        json.dump(messages, f, ensure_ascii=False, indent=2)
+    append_jsonl(MESSAGES_FILE, new_message)
     
     return redirect(url_for('index'))
 
@@ -829,17 +931,9 @@ def delete_message():
         data = request.get_json()
         message_id = data.get('message_id')
         
-        if message_id:
-            messages = []
-            if os.path.exists(MESSAGES_FILE):
-                with open(MESSAGES_FILE, 'r', encoding='utf-8') as f:
-                    messages = json.load(f)
-            
-            messages = [msg for msg in messages if msg.get('id') != message_id]
-            
-            with open(MESSAGES_FILE, 'w', encoding='utf-8') as f:
-                json.dump(messages, f, ensure_ascii=False, indent=2)
-            
+        # 只接受字符串 ID，其他类型写进墓碑文件会破坏读取
+        if isinstance(message_id, str) and message_id:
+            append_jsonl(MESSAGE_TOMBSTONES_FILE, message_id)
             return jsonify({'success': True})
         
         return jsonify({'success': False}), 400